@@ -0,0 +1,29 @@
+import json
+import os
+
+counts = {"passed": 0, "failed": 0, "errors": 0}
+
+
+def pytest_sessionstart(session):
+    for outcome in counts:
+        counts[outcome] = 0
+
+
+def pytest_collectreport(report):
+    if report.failed:
+        counts["errors"] += 1
+
+
+def pytest_runtest_logreport(report):
+    if report.when == "call":
+        if report.passed:
+            counts["passed"] += 1
+        elif report.failed:
+            counts["failed"] += 1
+    elif report.failed:
+        counts["errors"] += 1
+
+
+def pytest_sessionfinish(session, exitstatus):
+    with open(os.environ["SCOREBOARD"], "w") as f:
+        json.dump(counts, f)
@@ -1,76 +1,521 @@
 import argparse
 import ast
-from difflib import SequenceMatcher
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+from dataclasses import dataclass
+from difflib import Match, SequenceMatcher
+import functools
+import hashlib
+import importlib.util
+import json
+import multiprocessing
 import subprocess
 import os
 import sys
 import re
+import shutil
+import tempfile
+import threading
 
+try:
+    from rapidfuzz.distance import Indel
+except ImportError:
+    Indel = None
 
-def calculate_syntax_score(file_path):
+# Only looked up here: importing pytest would slow every one-shot run, and
+# only the --serve worker needs it in this process.
+HAVE_PYTEST = importlib.util.find_spec("pytest") is not None
 
+SCORE_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "code-assessor", "scores.json"
+)
+SCORE_CACHE_SIZE = 1024
+
+TOKEN_PATTERN = re.compile(r"\w+|\S")
+TOKEN_CACHE_SIZE = 128
+TOKEN_ID_LIMIT = 1 << 20
+MATCHER_CACHE_SIZE = 16
+
+_score_cache = None
+_score_cache_lock = threading.Lock()
+
+_token_cache = {}
+_token_ids = {}
+_token_lock = threading.Lock()
+
+_matcher_cache = {}
+_matcher_lock = threading.Lock()
+
+
+def content_digest(data):
+
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def file_digest(file_path):
+
+    with open(file_path, "rb") as f:
+        return content_digest(f.read())
+
+
+@dataclass
+class FileAnalysis:
+    path: str
+    source: bytes
+    digest: str
+
+    @classmethod
+    def load(cls, file_path):
+        # An unreadable file scores zero everywhere instead of aborting.
+        try:
+            with open(file_path, "rb") as f:
+                source = f.read()
+        except Exception as e:
+            return cls(file_path, None, None)
+        return cls(file_path, source, content_digest(source))
+
+    @functools.cached_property
+    def text(self):
+        return self.source.decode("utf-8")
+
+    @functools.cached_property
+    def tree(self):
+        # None when the source does not compile.
+        try:
+            return compile(
+                self.source,
+                self.path,
+                "exec",
+                flags=ast.PyCF_ONLY_AST,
+                dont_inherit=True,
+            )
+        except Exception as e:
+            return None
+
+    @functools.cached_property
+    def compiles(self):
+        # Always a full bytecode compile: parsing alone accepts code such as
+        # a module-level return, and the score must not depend on the mode.
+        try:
+            compile(self.source, self.path, "exec", dont_inherit=True)
+            return True
+        except Exception as e:
+            return False
+
+
+def load_score_cache():
+
+    global _score_cache
+    if _score_cache is None:
+        # Scores computed by a different version of this file, interpreter
+        # or similarity backend are stale: syntax and AST node types vary
+        # between Python versions.
+        version = ":".join(
+            [
+                file_digest(__file__),
+                sys.implementation.cache_tag,
+                similarity_backend(),
+            ]
+        )
+        _score_cache = {"version": version, "scores": {}}
+        try:
+            with open(SCORE_CACHE_PATH, "r", encoding="utf-8") as f:
+                stored = json.load(f)
+            if stored.get("version") == _score_cache["version"]:
+                _score_cache["scores"] = stored["scores"]
+        except Exception as e:
+            pass
+    return _score_cache["scores"]
+
+
+def save_score_cache():
+
+    if _score_cache is None:
+        return
     try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            ast.parse(f.read())
-        return 1.0
-    except SyntaxError as e:
-        return 0.0
+        cache_dir = os.path.dirname(SCORE_CACHE_PATH)
+        os.makedirs(cache_dir, exist_ok=True)
+        # Other graders may read or write the cache concurrently, so write a
+        # private file and swap it in whole.
+        fd, temp_path = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        try:
+            with _score_cache_lock, os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(_score_cache, f)
+            os.replace(temp_path, SCORE_CACHE_PATH)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+    except OSError as e:
+        pass
+
+
+def memoize_by_content(func):
+
+    @functools.wraps(func)
+    def wrapper(*analyses):
+        if any(a.digest is None for a in analyses):
+            return func(*analyses)
+        key = ":".join([func.__name__] + [a.digest for a in analyses])
+
+        with _score_cache_lock:
+            scores = load_score_cache()
+            if key in scores:
+                return scores[key]
+
+        score = func(*analyses)
+
+        with _score_cache_lock:
+            scores[key] = score
+            while len(scores) > SCORE_CACHE_SIZE:
+                del scores[next(iter(scores))]
+        return score
+
+    return wrapper
+
+
+class CachedSequenceMatcher(SequenceMatcher):
+
+    def find_longest_match(self, alo=0, ahi=None, blo=0, bhi=None):
+        # Same result as SequenceMatcher.find_longest_match, but the b2j
+        # candidates inside [blo, bhi) are filtered once per distinct a[i]
+        # instead of once per position.
+        a, b, b2j, isbjunk = self.a, self.b, self.b2j, self.bjunk.__contains__
+        if ahi is None:
+            ahi = len(a)
+        if bhi is None:
+            bhi = len(b)
+        besti, bestj, bestsize = alo, blo, 0
+        j2len = {}
+        candidates = {}
+        for i in range(alo, ahi):
+            elt = a[i]
+            js = candidates.get(elt)
+            if js is None:
+                js = candidates[elt] = [
+                    j for j in b2j.get(elt, ()) if blo <= j < bhi
+                ]
+            newj2len = {}
+            for j in js:
+                if j - 1 in j2len:
+                    k = newj2len[j] = j2len[j - 1] + 1
+                    if k > bestsize:
+                        besti, bestj, bestsize = i - k + 1, j - k + 1, k
+                else:
+                    newj2len[j] = 1
+                    if not bestsize:
+                        besti, bestj, bestsize = i, j, 1
+            j2len = newj2len
+
+        while (
+            besti > alo
+            and bestj > blo
+            and not isbjunk(b[bestj - 1])
+            and a[besti - 1] == b[bestj - 1]
+        ):
+            besti, bestj, bestsize = besti - 1, bestj - 1, bestsize + 1
+        while (
+            besti + bestsize < ahi
+            and bestj + bestsize < bhi
+            and not isbjunk(b[bestj + bestsize])
+            and a[besti + bestsize] == b[bestj + bestsize]
+        ):
+            bestsize += 1
+        while (
+            besti > alo
+            and bestj > blo
+            and isbjunk(b[bestj - 1])
+            and a[besti - 1] == b[bestj - 1]
+        ):
+            besti, bestj, bestsize = besti - 1, bestj - 1, bestsize + 1
+        while (
+            besti + bestsize < ahi
+            and bestj + bestsize < bhi
+            and isbjunk(b[bestj + bestsize])
+            and a[besti + bestsize] == b[bestj + bestsize]
+        ):
+            bestsize += 1
+
+        return Match(besti, bestj, bestsize)
+
+
+def lcs_length(a, b, prev, curr):
+
+    # Two-row LCS table, compiled by numba_lcs_ratio(); b is the shorter
+    # sequence and prev/curr are zeroed rows of len(b) + 1.
+    m = len(b)
+    for i in range(len(a)):
+        ai = a[i]
+        for j in range(1, m + 1):
+            if ai == b[j - 1]:
+                curr[j] = prev[j - 1] + 1
+            elif prev[j] >= curr[j - 1]:
+                curr[j] = prev[j]
+            else:
+                curr[j] = curr[j - 1]
+        prev, curr = curr, prev
+    return prev[m]
+
+
+@functools.lru_cache(maxsize=None)
+def numba_lcs_ratio():
+
+    # Imported on first use: numba alone costs ~350 ms and is only needed
+    # when rapidfuzz is missing.
+    try:
+        from numba import njit
+        import numpy as np
+    except ImportError:
+        return None
+
+    compiled_lcs_length = njit(cache=True)(lcs_length)
+
+    def lcs_ratio(a, b):
+        # Same scale as Indel.normalized_similarity.
+        if not a and not b:
+            return 1.0
+        if len(b) > len(a):
+            a, b = b, a
+        prev = np.zeros(len(b) + 1, np.int64)
+        curr = np.zeros(len(b) + 1, np.int64)
+        length = compiled_lcs_length(
+            np.asarray(a, np.int64), np.asarray(b, np.int64), prev, curr
+        )
+        return 2.0 * length / (len(a) + len(b))
+
+    return lcs_ratio
+
+
+def similarity_backend():
+
+    if Indel is not None:
+        return "rapidfuzz"
+    if numba_lcs_ratio() is not None:
+        return "numba"
+    return "difflib"
+
+
+def sequence_ratio(a, b, b_key=None):
+
+    if Indel is not None:
+        return Indel.normalized_similarity(a, b)
+    lcs_ratio = numba_lcs_ratio()
+    if lcs_ratio is not None:
+        return lcs_ratio(a, b)
+    if b_key is None:
+        return CachedSequenceMatcher(None, a, b, autojunk=False).ratio()
+
+    # SequenceMatcher indexes its second sequence, so keep one matcher per
+    # reference and only swap in each new generated sequence.
+    with _matcher_lock:
+        matcher = _matcher_cache.get(b_key)
+        if matcher is None or matcher.b is not b:
+            matcher = CachedSequenceMatcher(None, None, b, autojunk=False)
+            _matcher_cache[b_key] = matcher
+            while len(_matcher_cache) > MATCHER_CACHE_SIZE:
+                del _matcher_cache[next(iter(_matcher_cache))]
+        matcher.set_seq1(a)
+        return matcher.ratio()
+
+
+@memoize_by_content
+def calculate_syntax_score(analysis):
+
+    return 1.0 if analysis.compiles else 0.0
+
+
+def source_tokens(*analyses):
+
+    # Token ids are shared across files, so cached lists stay comparable
+    # and a reference graded many times is only tokenized once. The ids
+    # are only reset between calls, never while tokenizing one pair.
+    with _token_lock:
+        if len(_token_ids) > TOKEN_ID_LIMIT:
+            _token_ids.clear()
+            _token_cache.clear()
+
+        results = []
+        for analysis in analyses:
+            tokens = _token_cache.get(analysis.digest)
+            if tokens is None:
+                tokens = [
+                    _token_ids.setdefault(t, len(_token_ids))
+                    for t in TOKEN_PATTERN.findall(analysis.text)
+                ]
+                _token_cache[analysis.digest] = tokens
+            results.append(tokens)
+
+        while len(_token_cache) > TOKEN_CACHE_SIZE:
+            del _token_cache[next(iter(_token_cache))]
+        return results
+
+
+@memoize_by_content
+def calculate_similarity(generated, reference):
+
+    try:
+        gen_tokens, ref_tokens = source_tokens(generated, reference)
+        return sequence_ratio(gen_tokens, ref_tokens, b_key=reference.digest)
     except Exception as e:
         return 0.0
 
 
-def calculate_similarity(generated_path, reference_path):
+@memoize_by_content
+def calculate_ast_similarity(generated, reference):
 
     try:
-        with open(generated_path, "r", encoding="utf-8") as gen_file, open(
-            reference_path, "r", encoding="utf-8"
-        ) as ref_file:
+        if generated.tree is None or reference.tree is None:
+            return calculate_similarity(generated, reference)
 
-            gen_code = gen_file.read()
-            ref_code = ref_file.read()
-
-            gen_clean = " ".join(gen_code.split())
-            ref_clean = " ".join(ref_code.split())
+        # Compare node types only, so renames and comments do not count.
+        node_ids = {}
+        gen_nodes = [
+            node_ids.setdefault(type(node), len(node_ids))
+            for node in ast.walk(generated.tree)
+        ]
+        ref_nodes = [
+            node_ids.setdefault(type(node), len(node_ids))
+            for node in ast.walk(reference.tree)
+        ]
 
-            return SequenceMatcher(None, gen_clean, ref_clean).ratio()
+        return sequence_ratio(gen_nodes, ref_nodes)
     except Exception as e:
         return 0.0
 
 
-def run_tests(test_path, generated_path):
+def calculate_hybrid_similarity(generated, reference):
+
+    return 0.3 * calculate_similarity(
+        generated, reference
+    ) + 0.7 * calculate_ast_similarity(generated, reference)
+
+
+SIMILARITY_MODES = {
+    "text": calculate_similarity,
+    "ast": calculate_ast_similarity,
+    "hybrid": calculate_hybrid_similarity,
+}
+
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def pytest_args(test_path):
+
+    return [
+        "-p",
+        "assessor_scoreboard",
+        "-p",
+        "no:cacheprovider",
+        "-q",
+        "--no-header",
+        "--no-summary",
+        test_path,
+    ]
+
+
+@functools.lru_cache(maxsize=None)
+def pytest_context():
+
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        # pytest is imported once in the server and every run forks from it.
+        context.set_forkserver_preload(["pytest"])
+        return context
+    return multiprocessing.get_context("spawn")
+
+
+def pytest_worker(test_path, scoreboard):
+
+    import pytest
+
+    # This process is discarded after the run, so its output can simply go.
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+
+    # Same working directory as the subprocess fallback.
+    os.chdir(os.path.dirname(test_path))
+
+    if PLUGIN_DIR not in sys.path:
+        sys.path.insert(0, PLUGIN_DIR)
+    os.environ["SCOREBOARD"] = scoreboard
+
+    # A linked solution keeps the generated file's mtime, so a cached .pyc
+    # from an earlier solution of the same size could be picked up.
+    sys.dont_write_bytecode = True
+
+    pytest.main(pytest_args(test_path))
+
+
+def run_pytest_worker(test_path, scoreboard, timeout):
+
+    # A separate process, unlike a thread, can be killed when the tests hang.
+    worker = pytest_context().Process(
+        target=pytest_worker, args=(test_path, scoreboard), daemon=True
+    )
+    worker.start()
+    worker.join(timeout)
+
+    if worker.is_alive():
+        worker.kill()
+        worker.join()
+
+
+def run_pytest_subprocess(test_path, scoreboard, timeout):
+
+    env = dict(os.environ, SCOREBOARD=scoreboard, PYTHONDONTWRITEBYTECODE="1")
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [PLUGIN_DIR, env.get("PYTHONPATH")])
+    )
+
+    subprocess.run(
+        ["pytest"] + pytest_args(test_path),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        timeout=timeout,
+        cwd=os.path.dirname(test_path),
+        env=env,
+    )
+
+
+def run_tests(test_path, generated_path, timeout=30, in_process=False):
 
     try:
 
+        test_path = os.path.abspath(test_path)
         test_dir = os.path.dirname(test_path)
         temp_solution = os.path.join(test_dir, "solution.py")
 
-        with open(generated_path, "r", encoding="utf-8") as src, open(
-            temp_solution, "w", encoding="utf-8"
-        ) as dest:
-            dest.write(src.read())
-
-        result = subprocess.run(
-            ["pytest", test_path],
-            capture_output=True,
-            text=True,
-            timeout=30,
-            cwd=test_dir,
-        )
-
-        if os.path.exists(temp_solution):
+        # Never write through a leftover solution.py: it may be a hard link
+        # to another submission.
+        with contextlib.suppress(FileNotFoundError):
             os.remove(temp_solution)
 
-        passed_match = re.search(r"(\d+) passed", result.stdout)
-        failed_match = re.search(r"(\d+) failed", result.stdout)
-        error_match = re.search(r"(\d+) errors?", result.stdout, re.IGNORECASE)
+        try:
+            os.link(generated_path, temp_solution)
+        except OSError as e:
+            shutil.copyfile(generated_path, temp_solution)
+
+        # The assessor_scoreboard plugin writes the outcome counts here.
+        with tempfile.TemporaryDirectory() as scoreboard_dir:
+            scoreboard = os.path.join(scoreboard_dir, "scoreboard.json")
+            try:
+                # The worker only pays off across many runs (--serve); a
+                # single run is faster as a plain subprocess.
+                if in_process and HAVE_PYTEST:
+                    run_pytest_worker(test_path, scoreboard, timeout)
+                else:
+                    run_pytest_subprocess(test_path, scoreboard, timeout)
+            finally:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(temp_solution)
 
-        passed = int(passed_match.group(1)) if passed_match else 0
-        failed = int(failed_match.group(1)) if failed_match else 0
-        errors = int(error_match.group(1)) if error_match else 0
+            with open(scoreboard) as f:
+                counts = json.load(f)
 
-        total = passed + failed + errors
+        total = counts["passed"] + counts["failed"] + counts["errors"]
 
-        return passed / total if total > 0 else 0.0
+        return counts["passed"] / total if total > 0 else 0.0
 
     except subprocess.TimeoutExpired:
         return 0.0
@@ -78,46 +523,148 @@ def run_tests(test_path, generated_path):
         return 0.0
 
 
-def main():
-    parser = argparse.ArgumentParser(description="Code quality assessment tool")
-    parser.add_argument(
-        "--generated", required=True, help="Path to generated code file"
+def parse_weights(weights):
+
+    if isinstance(weights, str):
+        weights = weights.split(",")
+    weights = [float(w) for w in weights]
+    if len(weights) != 3 or abs(sum(weights) - 1.0) > 0.01:
+        weights = [0.3, 0.3, 0.4]
+    return weights
+
+
+def assess(
+    generated_path,
+    reference_path,
+    test_path,
+    weights,
+    similarity_mode,
+    timeout=30,
+    in_process=False,
+):
+
+    generated = FileAnalysis.load(generated_path)
+    reference = FileAnalysis.load(reference_path)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        similarity_future = executor.submit(
+            SIMILARITY_MODES[similarity_mode], generated, reference
+        )
+        syntax_score = calculate_syntax_score(generated)
+
+        # Code that does not parse cannot pass any test.
+        if syntax_score == 0.0:
+            test_score = 0.0
+        else:
+            test_score = executor.submit(
+                run_tests, test_path, generated_path, timeout, in_process
+            ).result()
+
+        similarity_score = similarity_future.result()
+
+    save_score_cache()
+
+    final_score = (
+        weights[0] * syntax_score
+        + weights[1] * similarity_score
+        + weights[2] * test_score
     )
-    parser.add_argument(
-        "--reference", required=True, help="Path to reference solution file"
+
+    return {
+        "syntax": syntax_score,
+        "similarity": similarity_score,
+        "tests": test_score,
+        "final": final_score,
+    }
+
+
+def serve(weights, similarity_mode, timeout):
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            job = json.loads(line)
+            scores = assess(
+                job["generated"],
+                job["reference"],
+                job["tests"],
+                parse_weights(job.get("weights", weights)),
+                job.get("similarity_mode", similarity_mode),
+                timeout,
+                in_process=True,
+            )
+        except Exception as e:
+            scores = {"error": str(e)}
+
+        print(json.dumps(scores), flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Code quality assessment tool",
+        epilog="If the generated code has a syntax error, the tests are not run "
+        "and the test score is 0.0.",
     )
-    parser.add_argument("--tests", required=True, help="Path to test file")
+    parser.add_argument("--generated", help="Path to generated code file")
+    parser.add_argument("--reference", help="Path to reference solution file")
+    parser.add_argument("--tests", help="Path to test file")
     parser.add_argument(
         "--weights",
         default="0.3,0.3,0.4",
         help="Comma-separated weights for syntax, similarity, tests",
     )
+    parser.add_argument(
+        "--similarity-mode",
+        choices=SIMILARITY_MODES,
+        default="text",
+        help="Compare source tokens (text), AST node types (ast), "
+        "or 0.3 text + 0.7 ast (hybrid)",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=30,
+        help="Seconds the tests may run before scoring 0.0",
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="Read one JSON job per line from stdin "
+        '({"generated", "reference", "tests", optional "weights" and '
+        '"similarity_mode"}) and write one JSON result per line, keeping '
+        "pytest loaded between jobs",
+    )
     args = parser.parse_args()
 
+    if not args.serve and not (args.generated and args.reference and args.tests):
+        parser.error("--generated, --reference and --tests are required")
+
     try:
 
-        weights = [float(w) for w in args.weights.split(",")]
-        if len(weights) != 3 or abs(sum(weights) - 1.0) > 0.01:
-            weights = [0.3, 0.3, 0.4]
+        weights = parse_weights(args.weights)
 
-        syntax_score = calculate_syntax_score(args.generated)
-        similarity_score = calculate_similarity(args.generated, args.reference)
-        test_score = run_tests(args.tests, args.generated)
+        if args.serve:
+            serve(weights, args.similarity_mode, args.timeout)
+            return
 
-        final_score = (
-            weights[0] * syntax_score
-            + weights[1] * similarity_score
-            + weights[2] * test_score
+        scores = assess(
+            args.generated,
+            args.reference,
+            args.tests,
+            weights,
+            args.similarity_mode,
+            args.timeout,
         )
 
         results = [
             "Code Assessment Results",
             "=======================",
-            f"Syntax Check:    {syntax_score:.2f}/1.0",
-            f"Code Similarity: {similarity_score:.2f}/1.0",
-            f"Tests Pass Rate: {test_score:.2f}/1.0",
+            f"Syntax Check:    {scores['syntax']:.2f}/1.0",
+            f"Code Similarity: {scores['similarity']:.2f}/1.0",
+            f"Tests Pass Rate: {scores['tests']:.2f}/1.0",
             "-----------------------",
-            f"FINAL SCORE:     {final_score:.2f}/1.0",
+            f"FINAL SCORE:     {scores['final']:.2f}/1.0",
             "=======================",
         ]
 
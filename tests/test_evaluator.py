@@ -0,0 +1,208 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import evaluator
+
+
+TESTS = """from solution import sum
+
+
+def test_sum():
+
+    assert sum(1, 2) == 3
+"""
+
+PASSING = """def sum(a, b):
+    return a + b
+"""
+
+HANGING = """def sum(a, b):
+    while True:
+        pass
+"""
+
+
+@pytest.fixture(autouse=True)
+def score_cache(tmp_path, monkeypatch):
+
+    monkeypatch.setattr(evaluator, "SCORE_CACHE_PATH", str(tmp_path / "scores.json"))
+    monkeypatch.setattr(evaluator, "_score_cache", None)
+
+
+def write(path, content):
+
+    path.write_text(content)
+    return str(path)
+
+
+@pytest.mark.parametrize("in_process", [True, False])
+def test_run_tests_recovers_after_timeout(tmp_path, in_process):
+
+    test_path = write(tmp_path / "test_solution.py", TESTS)
+    hanging = write(tmp_path / "hanging.py", HANGING)
+    passing = write(tmp_path / "passing.py", PASSING)
+
+    assert evaluator.run_tests(test_path, hanging, 2, in_process) == 0.0
+    assert evaluator.run_tests(test_path, passing, 30, in_process) == 1.0
+    assert not os.path.exists(tmp_path / "solution.py")
+
+
+def test_run_tests_leaves_a_linked_leftover_untouched(tmp_path):
+
+    test_path = write(tmp_path / "test_solution.py", TESTS)
+    previous = write(tmp_path / "previous.py", PASSING)
+    hanging = write(tmp_path / "hanging.py", HANGING)
+    os.link(previous, tmp_path / "solution.py")
+
+    evaluator.run_tests(test_path, hanging, timeout=2)
+
+    assert (tmp_path / "previous.py").read_text() == PASSING
+
+
+@pytest.mark.parametrize("in_process", [True, False])
+def test_run_tests_runs_in_the_test_directory(tmp_path, in_process):
+
+    write(tmp_path / "expected.txt", "3")
+    test_path = write(
+        tmp_path / "test_solution.py",
+        TESTS.replace("== 3", '== int(open("expected.txt").read())'),
+    )
+    passing = write(tmp_path / "passing.py", PASSING)
+
+    assert evaluator.run_tests(test_path, passing, in_process=in_process) == 1.0
+
+
+def test_assess_scores_unusable_input_instead_of_failing(tmp_path):
+
+    test_path = write(tmp_path / "test_solution.py", TESTS)
+    reference = write(tmp_path / "reference.py", PASSING)
+    too_deep = write(tmp_path / "too_deep.py", "x=" + "-" * 200000 + "1\n")
+    missing = str(tmp_path / "missing.py")
+
+    for generated in (too_deep, missing):
+        scores = evaluator.assess(
+            generated, reference, test_path, [0.3, 0.3, 0.4], "hybrid"
+        )
+        assert scores["syntax"] == 0.0
+        assert scores["tests"] == 0.0
+
+
+def analyses(tmp_path, generated):
+
+    return (
+        evaluator.FileAnalysis.load(write(tmp_path / "generated.py", generated)),
+        evaluator.FileAnalysis.load(write(tmp_path / "reference.py", PASSING)),
+    )
+
+
+def test_ast_similarity_ignores_renames_and_comments(tmp_path):
+
+    generated, reference = analyses(
+        tmp_path,
+        "def add(x, y):\n    # Both operands are numbers.\n    return x + y\n",
+    )
+
+    assert evaluator.calculate_ast_similarity(generated, reference) == 1.0
+    assert evaluator.calculate_similarity(generated, reference) < 1.0
+
+
+def test_ast_similarity_falls_back_to_text_when_a_file_does_not_parse(tmp_path):
+
+    generated, reference = analyses(tmp_path, PASSING.replace("):", ")"))
+
+    assert generated.tree is None
+    assert evaluator.calculate_ast_similarity(
+        generated, reference
+    ) == evaluator.calculate_similarity(generated, reference)
+
+
+def test_hybrid_similarity_weighs_text_and_ast(tmp_path):
+
+    generated, reference = analyses(
+        tmp_path, "def add(x, y):\n    total = x + y\n    return total\n"
+    )
+    text = evaluator.calculate_similarity(generated, reference)
+    tree = evaluator.calculate_ast_similarity(generated, reference)
+
+    assert text != tree
+    assert evaluator.calculate_hybrid_similarity(
+        generated, reference
+    ) == pytest.approx(0.3 * text + 0.7 * tree)
+
+
+@pytest.mark.parametrize("mode", ["text", "ast", "hybrid"])
+def test_syntax_score_does_not_depend_on_the_similarity_mode(tmp_path, mode):
+
+    test_path = write(tmp_path / "test_solution.py", TESTS)
+    reference = write(tmp_path / "reference.py", PASSING)
+    # Parses, but cannot be compiled or imported.
+    returns = write(tmp_path / "returns.py", PASSING + "return 1\n")
+
+    scores = evaluator.assess(returns, reference, test_path, [0.3, 0.3, 0.4], mode)
+
+    assert scores["syntax"] == 0.0
+    assert scores["tests"] == 0.0
+
+
+def test_score_cache_is_dropped_when_the_similarity_backend_changes(monkeypatch):
+
+    monkeypatch.setattr(evaluator, "similarity_backend", lambda: "rapidfuzz")
+    evaluator.load_score_cache()["calculate_similarity:a:b"] = 0.5
+    evaluator.save_score_cache()
+
+    monkeypatch.setattr(evaluator, "_score_cache", None)
+    assert evaluator.load_score_cache() == {"calculate_similarity:a:b": 0.5}
+
+    monkeypatch.setattr(evaluator, "_score_cache", None)
+    monkeypatch.setattr(evaluator, "similarity_backend", lambda: "difflib")
+    assert evaluator.load_score_cache() == {}
+
+
+def test_serve_recovers_after_a_timed_out_job(tmp_path):
+
+    test_path = write(tmp_path / "test_solution.py", TESTS)
+    reference = write(tmp_path / "reference.py", PASSING)
+    jobs = [
+        {
+            "generated": write(tmp_path / name, content),
+            "reference": reference,
+            "tests": test_path,
+        }
+        for name, content in (("hanging.py", HANGING), ("passing.py", PASSING))
+    ]
+
+    result = subprocess.run(
+        [
+            sys.executable,
+            os.path.join(ROOT, "evaluator.py"),
+            "--serve",
+            "--timeout",
+            "2",
+        ],
+        input="".join(json.dumps(job) + "\n" for job in jobs),
+        capture_output=True,
+        text=True,
+        timeout=60,
+        env={**os.environ, "HOME": str(tmp_path)},
+    )
+
+    scores = [json.loads(line) for line in result.stdout.splitlines()]
+    assert [score["tests"] for score in scores] == [0.0, 1.0]
+
+
+def test_score_cache_is_dropped_when_the_interpreter_changes(tmp_path, monkeypatch):
+
+    evaluator.load_score_cache()["calculate_syntax_score:a"] = 1.0
+    evaluator.save_score_cache()
+    assert os.listdir(tmp_path) == ["scores.json"]
+
+    monkeypatch.setattr(evaluator, "_score_cache", None)
+    monkeypatch.setattr(sys.implementation, "cache_tag", "cpython-0")
+    assert evaluator.load_score_cache() == {}